@@ -3,6 +3,7 @@
 import random
 import re
 from collections import Counter
+from profiler import get_profiler
 from specific_word_detection import emotion_word_found, detect_emotion_phrase
 
 
@@ -114,12 +115,19 @@ class ChatBot:
         return response
 
     def chat(self):
-        """Start a chat with the chatbot."""
+        """Start a chat with the chatbot.
+
+        Profiling is opt-in; see the `profiler` module for the environment
+        variables and signal that turn it on.
+        """
+        profiler = get_profiler()
         try:
             message = input('> ')
             while message.lower() not in ('exit', 'quit','bye','goodbye','thanks i need to go','adios','okay thanks','okay bye'):
                 print()
-                print(f'{self.__class__.__name__}: {self.respond(message)}')
+                with profiler.message(self, message):
+                    response = self.respond(message)
+                print(f'{self.__class__.__name__}: {response}')
                 print()
                 message = input('> ')
         except (EOFError, KeyboardInterrupt):
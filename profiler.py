@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+"""Opt-in profiling for live chatbot workers.
+
+Profiling is controlled by the following environment variables:
+
+* PROFILE_SECONDS: sample stacks for this many seconds as soon as the bot
+    starts.
+* SLOW_MESSAGE_SECONDS: sample every `respond` call as often as possible, and
+    dump the samples for any call that takes longer than this many seconds.
+* PROFILE_INTERVAL: seconds between stack samples (default 0.005, at most 1).
+* PROFILE_DIR: where output files are written (default ".").
+
+Sending the process SIGUSR1 opens a sampling window of PROFILE_SECONDS (or 30
+seconds if it is not set), even if none of the variables above are set. The
+signal handler only records the request; the window is opened the next time
+the bot polls the profiler, which happens before every message and on every
+pass of the Slack loop. SIGUSR1 is only hooked up when the profiler is created
+on the main thread.
+
+The slow message trap runs a second sampler thread alongside the message. The
+two threads share the GIL, so while a message is handled the trap lowers the
+interpreter's thread switch interval to 1 ms to get samples that often; this
+costs a little extra time inside the timed call, but far less than tracing
+every function call would.
+
+Sampled stacks are written in the collapsed-stack format that flamegraph.pl
+and speedscope read. Each stack is prefixed with the conversation state and
+the message length, so a flamegraph can be split by either. Samples taken while
+the profiler's own code is running are dropped. Once a window has been
+opened, a window that is still open when the process exits (normally or on
+SIGTERM) is cut short and written out.
+
+A bad setting prints a warning and turns profiling off; the profiler never
+stops the bot from responding.
+"""
+
+import atexit
+import math
+import signal
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from os import environ, getpid, makedirs, path
+from time import perf_counter, strftime
+
+DEFAULT_SECONDS = 30
+DEFAULT_INTERVAL = 0.005
+MAX_INTERVAL = 1.0
+SLOW_INTERVAL = 0.001
+IDLE_TAG = 'state:idle'
+
+
+def _get_float(name, default=None, maximum=None):
+    """Read a number from the environment.
+
+    Arguments:
+        name (str): The name of the environment variable.
+        default (float): The value to use if the variable is not set.
+        maximum (float): The largest value allowed, if any.
+
+    Returns:
+        float: The value of the variable.
+
+    Raises:
+        ValueError: If the variable is not a finite positive number no larger
+            than `maximum`.
+    """
+    if name in environ and environ[name]:
+        value = float(environ[name])
+        if not (math.isfinite(value) and value > 0):
+            raise ValueError(f'{name} must be a finite positive number, but got {environ[name]}')
+        if maximum is not None and value > maximum:
+            raise ValueError(f'{name} must be at most {maximum}, but got {environ[name]}')
+        return value
+    return default
+
+
+def _output_path(directory, prefix, suffix):
+    """Build a unique-enough path for an output file.
+
+    Arguments:
+        directory (str): The directory to write to.
+        prefix (str): The kind of output, eg. "profile".
+        suffix (str): The file extension.
+
+    Returns:
+        str: The path of the output file.
+    """
+    name = f'{prefix}-{getpid()}-{strftime("%Y%m%d-%H%M%S")}-{perf_counter():.6f}.{suffix}'
+    return path.join(directory, name)
+
+
+def _format_frame(frame):
+    """Describe a stack frame as a single collapsed-stack entry.
+
+    Arguments:
+        frame (frame): The stack frame.
+
+    Returns:
+        str: The function name and where it is defined.
+    """
+    code = frame.f_code
+    filename = path.basename(code.co_filename)
+    return f'{code.co_name} ({filename}:{code.co_firstlineno})'.replace(';', ':')
+
+
+def _write_stacks(output, counts):
+    """Write stack counts in collapsed-stack format.
+
+    Failures are reported but not raised, so that a full disk or a missing
+    directory cannot take down the bot.
+
+    Arguments:
+        output (str): The path to write to.
+        counts (Counter): The number of samples of each collapsed stack.
+
+    Returns:
+        bool: Whether the file was written.
+    """
+    try:
+        with open(output, 'w') as f:
+            for stack, count in sorted(counts.items()):
+                f.write(f'{stack} {count}\n')
+    except OSError as error:
+        print(f'WARNING: profiler could not write {output}: {error}')
+        return False
+    return True
+
+
+class StackSampler(threading.Thread):
+    """A background thread that samples the stack of another thread.
+
+    The sampler wakes up every `interval` seconds and records the current
+    stack of the target thread, prefixed with the tag of its owner. Samples
+    taken while the target is running profiler code are dropped. Sampling
+    ends after `seconds` have passed or when `stop` is called, whichever comes
+    first, and the counts are then written to `output` if one was given.
+    """
+
+    def __init__(self, owner, target_id, seconds, interval, output=None):
+        """Initialize a StackSampler.
+
+        Arguments:
+            owner (Profiler): The profiler whose `tag` labels each sample.
+            target_id (int): The ident of the thread to sample.
+            seconds (float): How long to sample for, or None to sample until
+                stopped.
+            interval (float): Seconds between samples.
+            output (str): The path to write the collapsed stacks to, or None
+                to leave them in `counts`.
+        """
+        super().__init__(name='stack-sampler', daemon=True)
+        self.owner = owner
+        self.target_id = target_id
+        self.seconds = seconds
+        self.interval = interval
+        self.output = output
+        self.counts = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        """Sample until the window closes, then write the output."""
+        end = None if self.seconds is None else perf_counter() + self.seconds
+        while end is None or perf_counter() < end:
+            frame = sys._current_frames().get(self.target_id)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                if frame.f_code.co_filename == __file__:
+                    stack = None
+                    break
+                stack.append(_format_frame(frame))
+                frame = frame.f_back
+            if stack is not None:
+                stack.append(self.owner.tag)
+                self.counts[';'.join(reversed(stack))] += 1
+            if self.stopped.wait(self.interval):
+                break
+        if self.output is not None:
+            if _write_stacks(self.output, self.counts):
+                print(f'profiler: wrote {sum(self.counts.values())} samples to {self.output}')
+
+    def stop(self):
+        """End sampling early and wait for the output to be written."""
+        self.stopped.set()
+        if self.is_alive() and self is not threading.current_thread():
+            self.join()
+
+
+class Profiler:
+    """Profiling hooks for a chatbot worker.
+
+    A Profiler does nothing until a window is opened or the slow message trap
+    is configured; `get_profiler` is the usual way to get one. Wrap each call to `respond` with `message` so that
+    samples are tagged and slow messages are trapped, and call `poll` from
+    long-running loops so that windows requested by signal are opened.
+    """
+
+    def __init__(self, seconds=None, slow_seconds=None, interval=DEFAULT_INTERVAL, directory='.'):
+        """Initialize a Profiler.
+
+        Arguments:
+            seconds (float): The length of a sampling window, or None to only
+                sample when asked to.
+            slow_seconds (float): The threshold for dumping the samples of a
+                message, or None to disable the slow message trap.
+            interval (float): Seconds between stack samples.
+            directory (str): Where output files are written.
+        """
+        self.seconds = seconds
+        self.slow_seconds = slow_seconds
+        self.interval = interval
+        self.directory = directory
+        self.tag = IDLE_TAG
+        self.sampler = None
+        self.target_id = threading.get_ident()
+        self.requested = threading.Event()
+        self.exit_hooked = False
+
+    @classmethod
+    def from_environ(cls):
+        """Create a Profiler configured from the environment.
+
+        A sampling window is started right away if PROFILE_SECONDS is set, and
+        SIGUSR1 is hooked up to request more windows if this is the main
+        thread and the platform has it. If the settings are invalid, a warning
+        is printed and a profiler that does nothing is returned.
+
+        Returns:
+            Profiler: The new profiler.
+        """
+        try:
+            profiler = cls(
+                seconds=_get_float('PROFILE_SECONDS'),
+                slow_seconds=_get_float('SLOW_MESSAGE_SECONDS'),
+                interval=_get_float('PROFILE_INTERVAL', DEFAULT_INTERVAL, MAX_INTERVAL),
+                directory=environ.get('PROFILE_DIR', '.'),
+            )
+            makedirs(profiler.directory, exist_ok=True)
+        except (ValueError, OSError) as error:
+            print(' '.join([
+                'WARNING:',
+                f'invalid profiler settings ({error});',
+                'profiling is disabled',
+            ]))
+            return cls()
+        if hasattr(signal, 'SIGUSR1') and _on_main_thread():
+            signal.signal(signal.SIGUSR1, profiler._on_signal)
+        if profiler.seconds:
+            profiler.start()
+        return profiler
+
+    def _on_signal(self, signum, frame):
+        """Request a sampling window when a signal is received.
+
+        Signal handlers run between bytecodes of the main thread, possibly
+        while it holds a threading lock, so this only sets a flag for `poll`.
+        """
+        self.requested.set()
+
+    def _hook_exit(self):
+        """Make sure open windows are written out when the process exits.
+
+        This is only done once a window has been opened, so that a bot that is
+        not being profiled keeps the default handling of SIGTERM.
+        """
+        if self.exit_hooked:
+            return
+        self.exit_hooked = True
+        atexit.register(self.stop)
+        if _on_main_thread() and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, _exit_on_signal)
+
+    def poll(self):
+        """Open a sampling window if one was requested by signal.
+
+        Returns:
+            bool: Whether a new window was started.
+        """
+        if not self.requested.is_set():
+            return False
+        self.requested.clear()
+        return self.start()
+
+    def start(self, seconds=None):
+        """Start sampling the calling thread, unless a window is already open.
+
+        Arguments:
+            seconds (float): The length of the window. Defaults to the
+                configured window length.
+
+        Returns:
+            bool: Whether a new window was started.
+        """
+        if self.sampler is not None and self.sampler.is_alive():
+            return False
+        self._hook_exit()
+        self.target_id = threading.get_ident()
+        self.sampler = StackSampler(
+            self,
+            self.target_id,
+            seconds or self.seconds or DEFAULT_SECONDS,
+            self.interval,
+            _output_path(self.directory, 'profile', 'folded'),
+        )
+        self.sampler.start()
+        return True
+
+    def stop(self):
+        """Close the open sampling window, if any, and write what it has."""
+        if self.sampler is not None:
+            self.sampler.stop()
+
+    @contextmanager
+    def message(self, bot, message):
+        """Profile the handling of one message.
+
+        Samples taken inside the block are tagged with the bot's state and
+        the message length. If the slow message trap is enabled, the block is
+        also sampled as often as possible, and the samples are written out if
+        it takes longer than the threshold.
+
+        Arguments:
+            bot (ChatBot): The chatbot handling the message.
+            message (str): The message from the user.
+        """
+        self.poll()
+        self.tag = f'state:{bot.state};length:{len(message)}'
+        trap = None
+        if self.slow_seconds is not None:
+            switch_interval = sys.getswitchinterval()
+            sys.setswitchinterval(SLOW_INTERVAL)
+            trap = StackSampler(self, threading.get_ident(), None, SLOW_INTERVAL)
+            trap.start()
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            if trap is not None:
+                trap.stop()
+                sys.setswitchinterval(switch_interval)
+                if elapsed > self.slow_seconds:
+                    self._dump_slow(trap.counts, elapsed)
+            self.tag = IDLE_TAG
+
+    def _dump_slow(self, counts, elapsed):
+        """Write the samples of a slow message.
+
+        Arguments:
+            counts (Counter): The samples taken while handling the message.
+            elapsed (float): How long the message took, in seconds.
+        """
+        output = _output_path(self.directory, 'slow', 'folded')
+        if _write_stacks(output, counts):
+            print(' '.join([
+                f'profiler: slow message ({elapsed:.3f}s, {self.tag})',
+                f'sampled to {output}',
+            ]))
+
+
+def _on_main_thread():
+    """Check whether signal handlers can be installed from this thread."""
+    return threading.current_thread() is threading.main_thread()
+
+
+def _exit_on_signal(signum, frame):
+    """Exit normally on a signal, so that open windows are written out."""
+    sys.exit(128 + signum)
+
+
+_profiler = None
+
+
+def get_profiler():
+    """Get the profiler shared by every bot in this process.
+
+    The profiler is created from the environment the first time this is
+    called, so that signals, exit hooks and the PROFILE_SECONDS window are
+    only set up once.
+
+    Returns:
+        Profiler: The shared profiler.
+    """
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler.from_environ()
+    return _profiler
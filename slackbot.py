@@ -7,6 +7,7 @@ from time import sleep
 from slackclient import SlackClient
 
 from oxycsbot import OxyCSBot # FIXME
+from profiler import get_profiler
 
 
 def get_token():
@@ -68,19 +69,25 @@ def run(bot_class):
     messages from Slack. The current interface to Slack only lets through @-
     messages, _not_ direct messages.
 
+    Profiling is opt-in; see the `profiler` module for the environment
+    variables and signal that turn it on.
+
     Arguments:
         bot_class (class): The class of the chatbot that will respond.
     """
     slack, bot_id = connect_to_slack()
     bot = bot_class()
+    profiler = get_profiler()
     while True:
         for event in slack.rtm_read():
             print(event)
             message = get_at_message(event, bot_id)
             if message:
                 channel = event['channel']
-                response = bot.respond(message)
+                with profiler.message(bot, message):
+                    response = bot.respond(message)
                 slack.api_call('chat.postMessage', channel=channel, text=response)
+        profiler.poll()
         sleep(1)
 
 